@@ -1,7 +1,15 @@
-from flask import Flask, render_template, request
+from flask import Flask, Response, abort, jsonify, render_template, request
 from flask_socketio import SocketIO, emit, join_room, leave_room
+import functools
+import hmac
+import json
+import os
 import random
 import string
+import sys
+import threading
+import time
+from collections import Counter, deque
 from threading import Timer, Lock
 import re
 
@@ -40,6 +48,114 @@ sid_to_room = {}
 # Track players in result phase (don't trigger disconnect for them)
 in_result_phase = {}  # { room_code: set(usernames) }
 
+# Players redirected to game.html whose game page hasn't joined yet
+in_transit = {}  # { room_code: set(usernames) }
+
+# { room_code: Timer } ends the game if a game page never joins
+transit_timers = {}
+TRANSIT_SECONDS = 15
+
+# { room_code: set(sid) } read-only viewers, kept in their own socket.io room
+spectators = {}
+
+# sid -> room_code (spectators only)
+spectator_rooms = {}
+
+# { room_code: game_over_data } for the last finished match
+game_results = {}
+
+# { room_code: int } bumped by every public state change
+state_versions = {}
+
+# { room_code: deque([(version, event, data)]) } recent state changes for delta sync
+state_logs = {}
+STATE_LOG_SIZE = 64
+
+# Outbound flow control: queue depth is measured in engine.io packets
+OUTBOUND_HIGH_WATERMARK = 64
+OUTBOUND_LOW_WATERMARK = 16
+OUTBOUND_STALL_SECONDS = 30
+OUTBOUND_CHECK_INTERVAL = 1
+
+# Dropped for slow consumers; everything else is always delivered
+LOW_PRIORITY_EVENTS = {'chat_message', 'update_ready_count'}
+
+# Latest payload wins when a slow consumer catches up
+COALESCED_EVENTS = {'update_ready_count'}
+
+# sid -> {'since': timestamp, 'dropped': int, 'pending': {event: data}}
+slow_consumers = {}
+
+# sid -> last measured outbound queue depth (non-zero only)
+queue_depths = {}
+
+outbound_stats = {'dropped_events': 0, 'stalled_disconnects': 0}
+outbound_monitor = {'started': False}
+outbound_lock = Lock()
+
+# Admin routes are disabled unless a token is configured
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN')
+
+# Handler wall-time tracing; TRACE_HANDLERS=0 leaves handlers unwrapped
+TRACE_HANDLERS = os.environ.get('TRACE_HANDLERS', '1') != '0'
+SLOW_HANDLER_MS = float(os.environ.get('SLOW_HANDLER_MS', '100'))
+
+# Deliberate pause between choices_finalized and the game.html redirect;
+# handlers that wait on it get it added to their slow threshold
+CHOOSE_REDIRECT_DELAY = 0.5
+
+PROFILE_MAX_SECONDS = 60
+PROFILE_INTERVAL = 0.005
+
+# { handler_name: {calls, total_ms, max_ms, slow} }
+handler_timings = {}
+
+# most recent handler calls over their slow threshold
+slow_events = deque(maxlen=200)
+
+profile_lock = Lock()
+
+MAX_TOURNAMENT_PLAYERS = 4096
+
+# Match starts are rate limited so a round doesn't fire every choose phase at once
+TOURNAMENT_MATCH_STARTS_PER_TICK = 10
+TOURNAMENT_TICK_SECONDS = 1
+
+# Both players must reach the choose page within this time or it's a walkover
+TOURNAMENT_ARRIVAL_SECONDS = 60
+
+# Finished tournaments and their rooms are dropped after this long
+TOURNAMENT_CLEANUP_SECONDS = 600
+
+# { tournament_id: {id, organizer, status, champion, version, rounds: [[match]]} }
+# status goes registration -> running -> finished; nothing is scheduled until
+# the organizer starts it, so players have time to open the bracket page
+tournaments = {}
+
+# { tournament_id: {'matches': [[json]], 'rounds': [json], 'body': json} }
+# Serialized bracket pieces; a match change re-serializes only that match
+tournament_views = {}
+
+# room_code -> (tournament_id, round_index, match_index)
+tournament_rooms = {}
+
+# username -> tournament_match payload, re-sent on every join until they arrive
+pending_matches = {}
+
+# { room_code: set(usernames) } tournament players whose choose page has joined
+match_arrivals = {}
+
+# { room_code: Timer } walkover if both players don't arrive in time
+arrival_timers = {}
+
+# (tournament_id, round_index, match_index) waiting for the scheduler
+match_queue = deque()
+match_queue_lock = Lock()
+tournament_scheduler = {'started': False}
+
+# (cleanup_time, tournament_id) for finished tournaments
+tournament_cleanups = deque()
+
 
 # ---------------------
 # QUESTION FILTERING
@@ -87,6 +203,83 @@ def filter_question(message):
     return True, ""
 
 
+# ---------------------
+# TRACING / PROFILING
+# ---------------------
+
+def traced(func=None, slow_ms=None):
+    # Usable as @traced or @traced(slow_ms=...). With tracing disabled the
+    # handler is returned as-is, so there is no per-call cost at all.
+    if func is None:
+        return lambda f: traced(f, slow_ms)
+    if not TRACE_HANDLERS:
+        return func
+
+    name = func.__name__
+    threshold = SLOW_HANDLER_MS if slow_ms is None else slow_ms
+    stats = handler_timings.setdefault(name, {'calls': 0, 'total_ms': 0.0, 'max_ms': 0.0, 'slow': 0})
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            stats['calls'] += 1
+            stats['total_ms'] += elapsed_ms
+            if elapsed_ms > stats['max_ms']:
+                stats['max_ms'] = elapsed_ms
+            if elapsed_ms >= threshold:
+                stats['slow'] += 1
+                room_code = None
+                if args and isinstance(args[0], dict):
+                    room_code = args[0].get('room_code')
+                elif args and isinstance(args[0], str):
+                    room_code = args[0]
+                slow_events.append({
+                    'handler': name,
+                    'ms': round(elapsed_ms, 2),
+                    'room_code': room_code,
+                    'at': time.time()
+                })
+                print(f"[SLOW] {name} took {elapsed_ms:.1f}ms (room {room_code})")
+
+    return wrapper
+
+
+def sample_stacks(seconds, interval=PROFILE_INTERVAL):
+    # Poor man's sampling profiler: walk every thread's stack at a fixed
+    # interval and count identical stacks (collapsed-stack format).
+    counts = Counter()
+    own_thread = threading.get_ident()
+    thread_names = {t.ident: t.name for t in threading.enumerate()}
+    deadline = time.monotonic() + seconds
+
+    while time.monotonic() < deadline:
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_thread:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            stack.append(thread_names.get(thread_id, str(thread_id)))
+            counts[';'.join(reversed(stack))] += 1
+        time.sleep(interval)
+
+    return counts
+
+
+def require_admin():
+    if not ADMIN_TOKEN:
+        abort(404)
+    token = request.headers.get('X-Admin-Token') or request.args.get('token') or ''
+    if not hmac.compare_digest(token, ADMIN_TOKEN):
+        abort(403)
+
+
 # ---------------------
 # ROUTES
 # ---------------------
@@ -137,6 +330,79 @@ def result_page():
     
     return render_template('result.html', room_code=room_code, username=username)
 
+@app.route('/spectate.html')
+def spectate_page():
+    room_code = request.args.get('room')
+    if not room_code:
+        return "Missing parameters", 400
+    return render_template('spectate.html', room_code=room_code.upper())
+
+@app.route('/metrics')
+def metrics():
+    return jsonify({
+        'connections': len(sid_to_room) + len(spectator_rooms),
+        'rooms': len(rooms),
+        'spectators': len(spectator_rooms),
+        'outbound': {
+            'high_watermark': OUTBOUND_HIGH_WATERMARK,
+            'low_watermark': OUTBOUND_LOW_WATERMARK,
+            'max_queue_depth': max(queue_depths.values(), default=0),
+            'total_queue_depth': sum(queue_depths.values()),
+            'queued_connections': len(queue_depths),
+            'slow_consumers': len(slow_consumers),
+            'dropped_events': outbound_stats['dropped_events'],
+            'stalled_disconnects': outbound_stats['stalled_disconnects']
+        }
+    })
+
+@app.route('/admin/profile')
+def admin_profile():
+    require_admin()
+    try:
+        seconds = float(request.args.get('seconds', 10))
+    except ValueError:
+        return "Invalid seconds", 400
+    seconds = min(max(seconds, 0.1), PROFILE_MAX_SECONDS)
+
+    if not profile_lock.acquire(blocking=False):
+        return "A profile is already running", 409
+    try:
+        print(f"[PROFILE] Sampling all threads for {seconds}s")
+        counts = sample_stacks(seconds)
+    finally:
+        profile_lock.release()
+
+    body = '\n'.join(f"{stack} {count}" for stack, count in counts.most_common()) + '\n'
+    return Response(body, mimetype='text/plain', headers={
+        'Content-Disposition': f'attachment; filename=profile-{int(time.time())}.collapsed'
+    })
+
+@app.route('/admin/handlers')
+def admin_handlers():
+    require_admin()
+    return jsonify({
+        'tracing': TRACE_HANDLERS,
+        'slow_threshold_ms': SLOW_HANDLER_MS,
+        'handlers': {
+            name: dict(stats, avg_ms=stats['total_ms'] / stats['calls'] if stats['calls'] else 0.0)
+            for name, stats in handler_timings.items()
+        },
+        'slow_events': list(slow_events)
+    })
+
+@app.route('/tournament')
+def tournament_page():
+    tournament_id = request.args.get('id', '').upper()
+    username = request.args.get('username', '')
+    return render_template('tournament.html', tournament_id=tournament_id, username=username)
+
+@app.route('/tournament/<tournament_id>.json')
+def tournament_view(tournament_id):
+    body = get_tournament_view(tournament_id.upper())
+    if body is None:
+        return "Tournament not found", 404
+    return Response(body, mimetype='application/json')
+
 @app.route('/instructions')
 def instructions_page():
     return render_template('instructions.html')
@@ -146,15 +412,19 @@ def instructions_page():
 # ROOM CREATION / JOIN
 # ---------------------
 
-@socketio.on('create_room')
-def handle_create_room(data):
-    username = data['username']
-
+def new_room_code():
     while True:
         room_code = ''.join(random.choices(string.ascii_uppercase + string.digits, k=6))
         if room_code not in rooms:
-            break
+            return room_code
 
+
+@socketio.on('create_room')
+@traced
+def handle_create_room(data):
+    username = data['username']
+
+    room_code = new_room_code()
     rooms[room_code] = [username]
     join_room(room_code)
 
@@ -166,10 +436,11 @@ def handle_create_room(data):
         pass
 
     emit('room_created', room_code)
-    emit('update_players', rooms[room_code], room=room_code)
+    push_state(room_code, 'update_players', rooms[room_code])
 
 
 @socketio.on('join_room_event')
+@traced
 def handle_join_room(data):
     username = data['username']
     room_code = data['room_code'].upper()
@@ -182,7 +453,8 @@ def handle_join_room(data):
         emit('join_result', {'success': False, 'message': 'Room is full'})
         return
 
-    if username not in rooms[room_code]:
+    roster_changed = username not in rooms[room_code]
+    if roster_changed:
         rooms[room_code].append(username)
 
     join_room(room_code)
@@ -194,11 +466,15 @@ def handle_join_room(data):
     except Exception:
         pass
 
-    emit('update_players', rooms[room_code], room=room_code)
+    if roster_changed:
+        push_state(room_code, 'update_players', rooms[room_code])
+    else:
+        emit('update_players', rooms[room_code], room=room_code)
     emit('join_result', {'success': True, 'host': rooms[room_code][0]}, to=request.sid)
 
 
 @socketio.on('join_game_room')
+@traced
 def handle_join_game_room(data):
     room_code = data['room_code']
     username = data['username']
@@ -214,16 +490,34 @@ def handle_join_game_room(data):
     
     player_sids[username] = request.sid
 
-    if room_code in rooms and username not in rooms[room_code]:
+    if room_code not in rooms:
+        return
+
+    if username in in_transit.get(room_code, ()):
+        in_transit[room_code].discard(username)
+        if not in_transit[room_code]:
+            clear_transit(room_code)
+
+    if not handle_tournament_arrival(room_code, username):
+        deliver_pending_match(username, request.sid)
+
+    if username not in rooms[room_code]:
         rooms[room_code].append(username)
         print(f"[JOIN] Re-added {username} to room {room_code}")
-
-    if room_code in rooms:
-        print(f"[JOIN] Room {room_code} players: {rooms[room_code]}")
+        push_state(room_code, 'update_players', rooms[room_code])
+    else:
         emit('update_players', rooms[room_code], room=room_code)
 
+    print(f"[JOIN] Room {room_code} players: {rooms[room_code]}")
+
+    # Pages that track state versions get the missed delta (or a snapshot)
+    # instead of polling for it.
+    if 'last_version' in data:
+        emit('state_sync', build_state_sync(room_code, data['last_version']), to=request.sid)
+
 
 @socketio.on('join_result_room')
+@traced
 def handle_join_result_room(data):
     room_code = data['room_code']
     username = data['username']
@@ -247,6 +541,258 @@ def handle_join_result_room(data):
         print(f"[RESULT] Sending player list to {username}: {rooms[room_code]}")
         emit('update_players', rooms[room_code], room=room_code)
 
+    deliver_pending_match(username, request.sid)
+
+
+# ---------------------
+# OUTBOUND FLOW CONTROL
+# ---------------------
+
+def get_queue_depth(sid):
+    # Packets waiting in the engine.io socket's outbound queue - this is
+    # where messages pile up for a stalled websocket or long-polling client.
+    try:
+        eio_sid = socketio.server.manager.eio_sid_from_sid(sid, '/')
+        return socketio.server.eio.sockets[eio_sid].queue.qsize()
+    except (AttributeError, KeyError, TypeError):
+        return 0
+
+
+def close_connection(sid):
+    # Socket.IO's disconnect() only queues a DISCONNECT packet behind the
+    # backlog. Abort the engine.io socket instead so the transport and its
+    # queue are released now; close(wait=True) would block on queue.join().
+    try:
+        eio_sid = socketio.server.manager.eio_sid_from_sid(sid, '/')
+        eio_socket = socketio.server.eio.sockets[eio_sid]
+    except (AttributeError, KeyError, TypeError):
+        return
+    eio_socket.close(wait=False, abort=True)
+    socketio.server.eio.sockets.pop(eio_sid, None)
+
+
+def get_channel(sid):
+    if sid in spectator_rooms:
+        return spectator_room(spectator_rooms[sid])
+    return sid_to_room.get(sid)
+
+
+def broadcast(event, data, room):
+    if event not in LOW_PRIORITY_EVENTS or not slow_consumers:
+        socketio.emit(event, data, room=room)
+        return
+
+    skipped = [sid for sid in list(slow_consumers) if get_channel(sid) == room]
+    for sid in skipped:
+        consumer = slow_consumers.get(sid)
+        if consumer is None:
+            continue
+        if event in COALESCED_EVENTS:
+            # Delivered later as the latest value, so not a drop
+            consumer['pending'][event] = data
+        else:
+            consumer['dropped'] += 1
+            outbound_stats['dropped_events'] += 1
+
+    socketio.emit(event, data, room=room, skip_sid=skipped or None)
+
+
+def flush_slow_consumer(sid):
+    consumer = slow_consumers.pop(sid, None)
+    if consumer is None:
+        return
+    print(f"[OUTBOUND] {sid} caught up, dropped {consumer['dropped']} messages")
+
+    for event, data in consumer['pending'].items():
+        socketio.emit(event, data, to=sid)
+    if consumer['dropped']:
+        socketio.emit('chat_message', {
+            'username': 'System',
+            'message': f"{consumer['dropped']} messages skipped while you were away"
+        }, to=sid)
+
+
+def check_outbound_queues():
+    now = time.time()
+    depths = {}
+
+    for sid in list(sid_to_room) + list(spectator_rooms):
+        depth = get_queue_depth(sid)
+        if depth:
+            depths[sid] = depth
+
+        if sid in slow_consumers:
+            if depth <= OUTBOUND_LOW_WATERMARK:
+                flush_slow_consumer(sid)
+            elif now - slow_consumers[sid]['since'] > OUTBOUND_STALL_SECONDS:
+                print(f"[OUTBOUND] {sid} stalled with {depth} queued packets, disconnecting")
+                slow_consumers.pop(sid, None)
+                outbound_stats['stalled_disconnects'] += 1
+                close_connection(sid)
+        elif depth >= OUTBOUND_HIGH_WATERMARK:
+            print(f"[OUTBOUND] {sid} is a slow consumer ({depth} queued packets)")
+            slow_consumers[sid] = {'since': now, 'dropped': 0, 'pending': {}}
+
+    queue_depths.clear()
+    queue_depths.update(depths)
+
+
+def outbound_monitor_loop():
+    while True:
+        socketio.sleep(OUTBOUND_CHECK_INTERVAL)
+        try:
+            check_outbound_queues()
+        except Exception as e:
+            print(f"[OUTBOUND] ERROR: {e}")
+
+
+def ensure_outbound_monitor():
+    with outbound_lock:
+        if outbound_monitor['started']:
+            return
+        outbound_monitor['started'] = True
+    socketio.start_background_task(outbound_monitor_loop)
+
+
+@socketio.on('connect')
+@traced
+def handle_connect(auth=None):
+    ensure_outbound_monitor()
+
+
+# ---------------------
+# STATE SYNC
+# ---------------------
+
+def push_state(room_code, event, data):
+    # Every public state change goes through here: bump the room's version,
+    # keep it for late joiners and push it once to players and spectators.
+    version = state_versions.get(room_code, 0) + 1
+    state_versions[room_code] = version
+
+    if isinstance(data, dict):
+        data = dict(data, version=version)
+
+    state_logs.setdefault(room_code, deque(maxlen=STATE_LOG_SIZE)).append((version, event, data))
+
+    socketio.emit(event, data, room=room_code)
+    emit_to_spectators(event, data, room_code)
+    return data
+
+
+def reset_state_log(room_code):
+    # Called when a rematch clears the previous result. The old game's events
+    # are dropped and a fresh snapshot is pushed so open pages reset their view.
+    state_logs.pop(room_code, None)
+    push_state(room_code, 'game_reset', build_room_snapshot(room_code))
+
+
+def build_state_sync(room_code, last_version):
+    version = state_versions.get(room_code, 0)
+    log = state_logs.get(room_code)
+
+    try:
+        last_version = int(last_version)
+    except (TypeError, ValueError):
+        last_version = -1
+
+    if 0 <= last_version <= version and log and log[0][0] <= last_version + 1:
+        return {
+            'version': version,
+            'events': [
+                {'version': v, 'event': event, 'data': data}
+                for v, event, data in log if v > last_version
+            ]
+        }
+
+    if last_version == version:
+        return {'version': version, 'events': []}
+
+    return {'version': version, 'snapshot': build_room_snapshot(room_code)}
+
+
+# ---------------------
+# SPECTATORS
+# ---------------------
+
+def spectator_room(room_code):
+    # Spectators live in a separate socket.io room so player-only emits
+    # (choices, redirects) never reach them and never iterate over them.
+    return f"{room_code}:spectators"
+
+
+def emit_to_spectators(event, data, room_code):
+    if spectators.get(room_code):
+        broadcast(event, data, spectator_room(room_code))
+
+
+def get_room_phase(room_code):
+    if room_code in game_results:
+        return 'finished'
+    if room_code in current_turns:
+        return 'playing'
+    if room_code in active_timers:
+        return 'choosing'
+    return 'lobby'
+
+
+def build_room_snapshot(room_code):
+    # Public state only - never include player_choices here.
+    return {
+        'room_code': room_code,
+        'phase': get_room_phase(room_code),
+        'players': list(rooms.get(room_code, [])),
+        'current_turn': current_turns.get(room_code),
+        'wrong_guesses': dict(wrong_guesses.get(room_code, {})),
+        'result': game_results.get(room_code),
+        'spectators': len(spectators.get(room_code, ())),
+        'version': state_versions.get(room_code, 0)
+    }
+
+
+def announce_game_over(room_code, game_over_data):
+    game_results[room_code] = game_over_data
+    push_state(room_code, 'game_over', game_over_data)
+
+    if room_code in tournament_rooms:
+        record_tournament_result(room_code, game_over_data['winner'])
+
+
+@socketio.on('spectate_room')
+@traced
+def handle_spectate_room(data):
+    room_code = (data.get('room_code') or '').upper()
+
+    if room_code not in rooms:
+        emit('spectate_result', {'success': False, 'message': 'Room not found'})
+        return
+
+    previous_room = spectator_rooms.get(request.sid)
+    if previous_room and previous_room != room_code:
+        leave_room(spectator_room(previous_room))
+        spectators.get(previous_room, set()).discard(request.sid)
+
+    join_room(spectator_room(room_code))
+    spectators.setdefault(room_code, set()).add(request.sid)
+    spectator_rooms[request.sid] = room_code
+
+    print(f"[SPECTATE] {request.sid} watching {room_code} ({len(spectators[room_code])} spectators)")
+
+    sync = build_state_sync(room_code, data.get('last_version'))
+    emit('spectate_result', dict(sync, success=True), to=request.sid)
+
+
+def remove_spectator(sid):
+    room_code = spectator_rooms.pop(sid, None)
+    if room_code is None:
+        return False
+    if room_code in spectators:
+        spectators[room_code].discard(sid)
+        if not spectators[room_code]:
+            del spectators[room_code]
+    print(f"[SPECTATE] {sid} stopped watching {room_code}")
+    return True
+
 
 # ---------------------
 # CHOOSE TIMER
@@ -268,11 +814,49 @@ def start_choose_timer(room_code):
         active_timers[room_code] = timer
 
 
+def start_transit_timer(room_code):
+    # A player who closes the tab while moving to game.html never sends a
+    # disconnect we act on, so give their game page a deadline to join.
+    with timer_lock:
+        if room_code in transit_timers:
+            transit_timers[room_code].cancel()
+        timer = Timer(TRANSIT_SECONDS, transit_timeout, args=(room_code,))
+        timer.start()
+        transit_timers[room_code] = timer
+
+
+def transit_timeout(room_code):
+    with timer_lock:
+        transit_timers.pop(room_code, None)
+    missing = in_transit.pop(room_code, set())
+    players = rooms.get(room_code, [])
+    loser = next((p for p in players if p in missing), None)
+    winner = next((p for p in players if p != loser), None)
+    if not loser or not winner or room_code not in current_turns or room_code in game_results:
+        return
+
+    print(f"[TRANSIT] {loser} never reached the game page in {room_code}, ending game")
+    announce_game_over(room_code, {
+        'winner': winner,
+        'loser': loser,
+        'reason': 'disconnect'
+    })
+
+
+def clear_transit(room_code):
+    in_transit.pop(room_code, None)
+    with timer_lock:
+        timer = transit_timers.pop(room_code, None)
+    if timer:
+        timer.cancel()
+
+
 # ---------------------
 # GAME START → CHOOSE PHASE
 # ---------------------
 
 @socketio.on('start_game')
+@traced
 def handle_start_game(data):
     room_code = data.get('room_code')
     username = data.get('username')
@@ -283,10 +867,15 @@ def handle_start_game(data):
     if rooms[room_code][0] != username:
         return
 
+    begin_choose_phase(room_code)
+
+
+def begin_choose_phase(room_code):
     start_choose_timer(room_code)
+    push_state(room_code, 'phase_change', {'phase': get_room_phase(room_code)})
 
     for player in rooms[room_code]:
-        emit('redirect_to_game', {
+        socketio.emit('redirect_to_game', {
             'room_code': room_code,
             'username': player
         }, room=room_code)
@@ -297,6 +886,7 @@ def handle_start_game(data):
 # ---------------------
 
 @socketio.on('player_ready')
+@traced
 def handle_player_ready(data):
     room_code = data.get('room_code')
     username = data.get('username')
@@ -314,13 +904,17 @@ def handle_player_ready(data):
     
     print(f"[READY] {len(ready_players[room_code])}/{len(rooms[room_code])} players ready")
     
-    socketio.emit('update_ready_count', {
+    broadcast('update_ready_count', {
         'ready_players': len(ready_players[room_code])
-    }, room=room_code)
+    }, room_code)
     
     if len(ready_players[room_code]) >= len(rooms[room_code]):
         print(f"[READY] Both players ready! Starting new game...")
         
+        # choose.html also sends player_ready on join, so only a cleared
+        # result means this is a rematch
+        is_rematch = room_code in game_results
+        
         if room_code in player_choices:
             del player_choices[room_code]
         if room_code in wrong_guesses:
@@ -329,7 +923,12 @@ def handle_player_ready(data):
             del current_turns[room_code]
         if room_code in in_result_phase:
             del in_result_phase[room_code]
+        clear_transit(room_code)
+        if room_code in game_results:
+            del game_results[room_code]
         
+        if is_rematch:
+            reset_state_log(room_code)
         ready_players[room_code] = set()
         
         print(f"[READY] Redirecting both players to choose phase...")
@@ -345,6 +944,7 @@ def handle_player_ready(data):
 # ---------------------
 
 @socketio.on('player_chose')
+@traced(slow_ms=SLOW_HANDLER_MS + CHOOSE_REDIRECT_DELAY * 1000)  # the last choice runs finish_choose_phase
 def player_chose(data):
     room = data['room_code']
     user = data['username']
@@ -387,6 +987,7 @@ def player_chose(data):
 # FINISH CHOOSE PHASE
 # ---------------------
 
+@traced(slow_ms=SLOW_HANDLER_MS + CHOOSE_REDIRECT_DELAY * 1000)
 def finish_choose_phase(room_code):
     print(f"\n[FINISH] ========== FINISHING CHOOSE PHASE ==========")
     print(f"[FINISH] Room: {room_code}")
@@ -435,7 +1036,7 @@ def finish_choose_phase(room_code):
     current_turns[room_code] = first_turn_player
     print(f"[FINISH] Initial turn: {first_turn_player}")
     
-    socketio.sleep(0.5)
+    socketio.sleep(CHOOSE_REDIRECT_DELAY)
     
     print(f"[FINISH] Redirecting players to game.html...")
 
@@ -447,20 +1048,17 @@ def finish_choose_phase(room_code):
                     'choice': info['choice'],
                     'first_turn': first_turn_player
                 }
+                in_transit.setdefault(room_code, set()).add(info['username'])
                 socketio.emit('redirect_to_gameplay', redirect_data, to=sid)
                 print(f"[FINISH] → Sent redirect to SID {sid} for player {info['username']} with choice={info['choice']}")
 
+    start_transit_timer(room_code)
+
+    # game.html picks this up through state_sync when its socket joins
     print(f"[FINISH] Emitting turn_update to room {room_code}...")
-    socketio.emit('turn_update', {
+    push_state(room_code, 'turn_update', {
         'current_turn': current_turns[room_code]
-    }, room=room_code)
-    
-    for player in players:
-        player_sid = player_sids.get(player)
-        if player_sid:
-            socketio.emit('turn_update', {
-                'current_turn': current_turns[room_code]
-            }, to=player_sid)
+    })
 
     with timer_lock:
         if room_code in active_timers:
@@ -474,6 +1072,7 @@ def finish_choose_phase(room_code):
 # ---------------------
 
 @socketio.on('chat_message')
+@traced
 def handle_chat_message(data):
     room_code = data.get('room_code')
     username = data.get('username')
@@ -502,10 +1101,12 @@ def handle_chat_message(data):
                 return
     
     # Broadcast message to all players in room
-    socketio.emit('chat_message', {
+    chat_data = {
         'username': username,
         'message': message
-    }, room=room_code)
+    }
+    broadcast('chat_message', chat_data, room_code)
+    emit_to_spectators('chat_message', chat_data, room_code)
     print(f"[CHAT] Message broadcasted to room {room_code}")
 
 
@@ -514,6 +1115,7 @@ def handle_chat_message(data):
 # ---------------------
 
 @socketio.on('make_guess')
+@traced
 def handle_make_guess(data):
     room_code = data['room_code']
     username = data['username']
@@ -542,25 +1144,13 @@ def handle_make_guess(data):
         in_result_phase[room_code].add(username)
         in_result_phase[room_code].add(opponent)
         
-        # Send to guesser
-        guesser_sid = player_sids.get(username)
-        if guesser_sid:
-            socketio.emit('guess_result', {
-                'success': True,
-                'guesser': username,
-                'guessed_id': guessed_id,
-                'correct_meme_name': get_meme_name(opponent_choice)
-            }, to=guesser_sid)
-        
-        # Send to opponent
-        opponent_sid = player_sids.get(opponent)
-        if opponent_sid:
-            socketio.emit('guess_result', {
-                'success': False,
-                'guesser': username,
-                'guessed_id': guessed_id,
-                'correct_meme_name': get_meme_name(opponent_choice)
-            }, to=opponent_sid)
+        # Opponent's page ignores a correct guess and waits for game_over
+        push_state(room_code, 'guess_result', {
+            'success': True,
+            'guesser': username,
+            'guessed_id': guessed_id,
+            'correct_meme_name': get_meme_name(opponent_choice)
+        })
         
         # Send game over to both
         game_over_data = {
@@ -570,10 +1160,7 @@ def handle_make_guess(data):
             'correct_meme_name': get_meme_name(opponent_choice)
         }
         
-        for player in [username, opponent]:
-            player_sid = player_sids.get(player)
-            if player_sid:
-                socketio.emit('game_over', game_over_data, to=player_sid)
+        announce_game_over(room_code, game_over_data)
         
     else:
         if room_code not in wrong_guesses:
@@ -582,12 +1169,13 @@ def handle_make_guess(data):
         wrong_count = wrong_guesses[room_code][username]
         print(f"[GUESS] ❌ Wrong! {username} now has {wrong_count}/3 wrong guesses")
         
-        emit('guess_result', {
+        guess_data = {
             'success': False,
             'guesser': username,
             'guessed_id': guessed_id,
             'wrong_count': wrong_count
-        }, room=room_code)
+        }
+        push_state(room_code, 'guess_result', guess_data)
         
         if wrong_count >= 3:
             print(f"[GUESS] 🏁 {username} lost! 3 wrong guesses")
@@ -604,33 +1192,17 @@ def handle_make_guess(data):
                 'reason': 'too_many_wrong_guesses'
             }
             
-            for player in [username, opponent]:
-                player_sid = player_sids.get(player)
-                if player_sid:
-                    socketio.emit('game_over', game_over_data, to=player_sid)
+            announce_game_over(room_code, game_over_data)
             return
         
         current_turns[room_code] = opponent
-        socketio.emit('turn_update', {
+        push_state(room_code, 'turn_update', {
             'current_turn': current_turns[room_code]
-        }, room=room_code)
-
-
-@socketio.on('request_turn_update')
-def handle_request_turn_update(data):
-    room_code = data.get('room_code')
-    username = sid_to_username.get(request.sid, 'Unknown')
-    print(f"[TURN] Turn update requested for room {room_code} by {username}")
-    
-    if room_code in current_turns:
-        emit('turn_update', {'current_turn': current_turns[room_code]}, to=request.sid)
-    else:
-        if room_code in rooms and len(rooms[room_code]) > 0:
-            current_turns[room_code] = rooms[room_code][0]
-            emit('turn_update', {'current_turn': current_turns[room_code]}, to=request.sid)
+        })
 
 
 @socketio.on('skip_turn')
+@traced
 def handle_skip_turn(data):
     room_code = data['room_code']
     username = data['username']
@@ -641,14 +1213,17 @@ def handle_skip_turn(data):
     opponent = next((p for p in rooms[room_code] if p != username), None)
     if opponent:
         current_turns[room_code] = opponent
-        socketio.emit('turn_update', {'current_turn': opponent}, room=room_code)
-        socketio.emit('chat_message', {
+        push_state(room_code, 'turn_update', {'current_turn': opponent})
+        skip_message = {
             'username': 'System',
             'message': f'{username} skipped a turn'
-        }, room=room_code)
+        }
+        broadcast('chat_message', skip_message, room_code)
+        emit_to_spectators('chat_message', skip_message, room_code)
 
 
 @socketio.on('surrender')
+@traced
 def handle_surrender(data):
     room_code = data['room_code']
     username = data['username']
@@ -667,9 +1242,7 @@ def handle_surrender(data):
             'reason': 'surrender'
         }
         
-        opponent_sid = player_sids.get(opponent)
-        if opponent_sid:
-            socketio.emit('game_over', game_over_data, to=opponent_sid)
+        announce_game_over(room_code, game_over_data)
 
 
 # ---------------------
@@ -677,6 +1250,7 @@ def handle_surrender(data):
 # ---------------------
 
 @socketio.on('leave_game')
+@traced
 def handle_leave_game(data):
     room_code = data['room_code']
     username = data['username']
@@ -693,19 +1267,33 @@ def handle_leave_game(data):
         if len(rooms[room_code]) > 0:
             print(f"[LEAVE] Notifying remaining players in {room_code}")
             socketio.emit('player_disconnected', {'username': username}, room=room_code, skip_sid=request.sid)
-            emit('update_players', rooms[room_code], room=room_code)
+            push_state(room_code, 'update_players', rooms[room_code])
         
         # Clean up if room is empty
         if len(rooms[room_code]) == 0:
-            for d in [rooms, player_choices, ready_players, current_turns, wrong_guesses, in_result_phase]:
-                d.pop(room_code, None)
+            cleanup_room(room_code)
             print(f"[LEAVE] Room {room_code} cleaned up")
 
 
+def cleanup_room(room_code):
+    clear_transit(room_code)
+    for d in [rooms, player_choices, ready_players, current_turns, wrong_guesses, in_result_phase, game_results, spectators,
+              state_versions, state_logs]:
+        d.pop(room_code, None)
+
+
 @socketio.on('disconnect')
-def handle_disconnect():
+@traced
+def handle_disconnect(reason=None):
     print(f"[DISCONNECT] Client disconnected: {request.sid}")
     
+    slow_consumers.pop(request.sid, None)
+    queue_depths.pop(request.sid, None)
+    
+    # Spectators never affect the match
+    if remove_spectator(request.sid):
+        return
+    
     disconnected_username = sid_to_username.get(request.sid)
     room_code = sid_to_room.get(request.sid)
     
@@ -722,7 +1310,17 @@ def handle_disconnect():
                 del sid_to_room[request.sid]
             return
     
-    if disconnected_username and room_code:
+    # The choose page closing on its way to game.html is not a disconnect
+    if disconnected_username in in_transit.get(room_code, ()):
+        print(f"[DISCONNECT] {disconnected_username} is moving to the game page, ignoring disconnect")
+        sid_to_username.pop(request.sid, None)
+        sid_to_room.pop(request.sid, None)
+        return
+    
+    # Only the player's current socket counts; older pages closing don't
+    is_current_sid = request.sid == player_sids.get(disconnected_username)
+    
+    if disconnected_username and room_code and is_current_sid:
         if room_code in rooms and disconnected_username in rooms[room_code]:
             remaining_players = [p for p in rooms[room_code] if p != disconnected_username]
             
@@ -737,16 +1335,14 @@ def handle_disconnect():
                     }, to=remaining_sid)
             
             # If this was during gameplay, trigger game over
-            if remaining_players and room_code in current_turns:
+            if remaining_players and room_code in current_turns and room_code not in game_results:
                 remaining_player = remaining_players[0]
                 game_over_data = {
                     'winner': remaining_player,
                     'loser': disconnected_username,
                     'reason': 'disconnect'
                 }
-                remaining_sid = player_sids.get(remaining_player)
-                if remaining_sid:
-                    socketio.emit('game_over', game_over_data, to=remaining_sid)
+                announce_game_over(room_code, game_over_data)
     
     # Cleanup
     if request.sid in sid_to_username:
@@ -755,6 +1351,336 @@ def handle_disconnect():
         del sid_to_room[request.sid]
 
 
+# ---------------------
+# TOURNAMENTS
+# ---------------------
+
+def bracket_room(tournament_id):
+    return f"{tournament_id}:bracket"
+
+
+def build_bracket(players):
+    # Single elimination padded to a power of two. Byes go to the first
+    # matches so no match is ever empty on both sides.
+    size = 1
+    while size < len(players):
+        size *= 2
+    byes = size - len(players)
+
+    first_round = []
+    remaining = iter(players)
+    for match_index in range(size // 2):
+        if match_index < byes:
+            pair = [next(remaining), None]
+        else:
+            pair = [next(remaining), next(remaining)]
+        first_round.append({'players': pair, 'winner': None, 'room_code': None, 'status': 'pending'})
+
+    rounds = [first_round]
+    while len(rounds[-1]) > 1:
+        rounds.append([
+            {'players': [None, None], 'winner': None, 'room_code': None, 'status': 'pending'}
+            for _ in range(len(rounds[-1]) // 2)
+        ])
+    return rounds
+
+
+def build_tournament_view(tournament):
+    matches = [[json.dumps(match) for match in round_matches] for round_matches in tournament['rounds']]
+    return {'matches': matches, 'rounds': [None] * len(matches), 'body': None}
+
+
+def get_tournament_view(tournament_id):
+    # Only rounds touched since the last request are re-joined; matches
+    # themselves are serialized when they change, not per request.
+    if tournament_id not in tournaments:
+        return None
+    view = tournament_views[tournament_id]
+    if view['body'] is None:
+        tournament = tournaments[tournament_id]
+        for round_index, chunk in enumerate(view['rounds']):
+            if chunk is None:
+                view['rounds'][round_index] = '[' + ','.join(view['matches'][round_index]) + ']'
+        header = json.dumps({
+            'id': tournament_id,
+            'organizer': tournament['organizer'],
+            'status': tournament['status'],
+            'champion': tournament['champion'],
+            'version': tournament['version']
+        })
+        view['body'] = header[:-1] + ', "rounds": [' + ','.join(view['rounds']) + ']}'
+    return view['body']
+
+
+def update_matches(tournament_id, changes):
+    # changes: [(round_index, match_index, {field: value})], sent as one update
+    tournament = tournaments[tournament_id]
+    view = tournament_views[tournament_id]
+    tournament['version'] += 1
+
+    entries = []
+    for round_index, match_index, fields in changes:
+        match = tournament['rounds'][round_index][match_index]
+        match.update(fields)
+        view['matches'][round_index][match_index] = json.dumps(match)
+        view['rounds'][round_index] = None
+        entries.append({'round': round_index, 'match': match_index, 'entry': match})
+    view['body'] = None
+
+    socketio.emit('bracket_update', {
+        'entries': entries,
+        'status': tournament['status'],
+        'champion': tournament['champion'],
+        'version': tournament['version']
+    }, room=bracket_room(tournament_id))
+
+
+def update_match(tournament_id, round_index, match_index, **fields):
+    update_matches(tournament_id, [(round_index, match_index, fields)])
+
+
+def enqueue_match(tournament_id, round_index, match_index):
+    with match_queue_lock:
+        match_queue.append((tournament_id, round_index, match_index))
+    ensure_tournament_scheduler()
+
+
+def finish_match(tournament_id, round_index, match_index, winner, status='finished'):
+    tournament = tournaments[tournament_id]
+    rounds = tournament['rounds']
+
+    if round_index == len(rounds) - 1:
+        tournament['status'] = 'finished'
+        tournament['champion'] = winner
+        print(f"[TOURNAMENT] {tournament_id} won by {winner}")
+        update_match(tournament_id, round_index, match_index, winner=winner, status=status)
+        with match_queue_lock:
+            tournament_cleanups.append((time.time() + TOURNAMENT_CLEANUP_SECONDS, tournament_id))
+        return
+
+    next_match = rounds[round_index + 1][match_index // 2]
+    next_players = list(next_match['players'])
+    next_players[match_index % 2] = winner
+    update_matches(tournament_id, [
+        (round_index, match_index, {'winner': winner, 'status': status}),
+        (round_index + 1, match_index // 2, {'players': next_players})
+    ])
+
+    if None not in next_players:
+        enqueue_match(tournament_id, round_index + 1, match_index // 2)
+
+
+def cleanup_tournament(tournament_id):
+    tournament = tournaments.pop(tournament_id, None)
+    tournament_views.pop(tournament_id, None)
+    if tournament is None:
+        return
+    for round_matches in tournament['rounds']:
+        for match in round_matches:
+            if match['room_code']:
+                cleanup_room(match['room_code'])
+                tournament_rooms.pop(match['room_code'], None)
+    print(f"[TOURNAMENT] {tournament_id} cleaned up")
+
+
+def record_tournament_result(room_code, winner):
+    tournament_id, round_index, match_index = tournament_rooms.pop(room_code)
+    if tournament_id not in tournaments:
+        return
+    print(f"[TOURNAMENT] {tournament_id} round {round_index + 1} match {match_index + 1}: {winner} advances")
+    finish_match(tournament_id, round_index, match_index, winner)
+
+
+def spawn_tournament_match(tournament_id, round_index, match_index):
+    if tournament_id not in tournaments:
+        return
+    match = tournaments[tournament_id]['rounds'][round_index][match_index]
+    players = match['players']
+
+    room_code = new_room_code()
+    rooms[room_code] = list(players)
+    tournament_rooms[room_code] = (tournament_id, round_index, match_index)
+    match_arrivals[room_code] = set()
+    update_match(tournament_id, round_index, match_index, room_code=room_code, status='playing')
+
+    # Players may still be on the previous match's game or result page, or
+    # not connected at all yet, so the assignment is kept and re-sent on
+    # every join until they arrive. The choose phase only starts once both
+    # choose pages have joined; no-shows are settled by arrival_timeout.
+    for player in players:
+        pending_matches[player] = {
+            'tournament_id': tournament_id,
+            'round': round_index,
+            'room_code': room_code,
+            'players': list(players)
+        }
+        deliver_pending_match(player, player_sids.get(player))
+
+    with timer_lock:
+        timer = Timer(TOURNAMENT_ARRIVAL_SECONDS, arrival_timeout, args=(room_code,))
+        timer.start()
+        arrival_timers[room_code] = timer
+
+    print(f"[TOURNAMENT] {tournament_id} round {round_index + 1} match {match_index + 1} -> room {room_code}")
+
+
+def deliver_pending_match(username, sid):
+    assignment = pending_matches.get(username)
+    if assignment and sid:
+        socketio.emit('tournament_match', assignment, to=sid)
+
+
+def handle_tournament_arrival(room_code, username):
+    assignment = pending_matches.get(username)
+    if room_code not in match_arrivals or not assignment or assignment['room_code'] != room_code:
+        return False
+
+    del pending_matches[username]
+    match_arrivals[room_code].add(username)
+    print(f"[TOURNAMENT] {username} arrived in {room_code} ({len(match_arrivals[room_code])}/2)")
+
+    if len(match_arrivals[room_code]) == len(rooms[room_code]):
+        del match_arrivals[room_code]
+        with timer_lock:
+            timer = arrival_timers.pop(room_code, None)
+        if timer:
+            timer.cancel()
+        begin_choose_phase(room_code)
+    return True
+
+
+def arrival_timeout(room_code):
+    with timer_lock:
+        arrival_timers.pop(room_code, None)
+    arrived = match_arrivals.pop(room_code, None)
+    if arrived is None or room_code not in tournament_rooms:
+        return
+
+    players = rooms.get(room_code, [])
+    for player in players:
+        if pending_matches.get(player, {}).get('room_code') == room_code:
+            del pending_matches[player]
+
+    tournament_id, round_index, match_index = tournament_rooms.pop(room_code)
+    winner = next((p for p in players if p in arrived), players[0])
+    print(f"[TOURNAMENT] {room_code} players didn't arrive in time, walkover for {winner}")
+    if tournament_id in tournaments:
+        finish_match(tournament_id, round_index, match_index, winner, status='walkover')
+
+
+def tournament_scheduler_loop():
+    while True:
+        socketio.sleep(TOURNAMENT_TICK_SECONDS)
+        with match_queue_lock:
+            due = [match_queue.popleft() for _ in range(min(TOURNAMENT_MATCH_STARTS_PER_TICK, len(match_queue)))]
+            expired = []
+            while tournament_cleanups and tournament_cleanups[0][0] <= time.time():
+                expired.append(tournament_cleanups.popleft()[1])
+        for entry in due:
+            try:
+                spawn_tournament_match(*entry)
+            except Exception as e:
+                print(f"[TOURNAMENT] ERROR starting match {entry}: {e}")
+        for tournament_id in expired:
+            cleanup_tournament(tournament_id)
+
+
+def ensure_tournament_scheduler():
+    with match_queue_lock:
+        if tournament_scheduler['started']:
+            return
+        tournament_scheduler['started'] = True
+    socketio.start_background_task(tournament_scheduler_loop)
+
+
+@socketio.on('create_tournament')
+@traced
+def handle_create_tournament(data):
+    organizer = data.get('username')
+    players = list(dict.fromkeys(p.strip() for p in data.get('players', []) if p and p.strip()))
+
+    if len(players) < 2:
+        emit('tournament_created', {'success': False, 'message': 'At least 2 players are required'})
+        return
+    if len(players) > MAX_TOURNAMENT_PLAYERS:
+        emit('tournament_created', {'success': False, 'message': f'At most {MAX_TOURNAMENT_PLAYERS} players allowed'})
+        return
+
+    while True:
+        tournament_id = 'T' + ''.join(random.choices(string.ascii_uppercase + string.digits, k=5))
+        if tournament_id not in tournaments:
+            break
+
+    random.shuffle(players)
+    tournaments[tournament_id] = {
+        'id': tournament_id,
+        'organizer': organizer,
+        'status': 'registration',
+        'champion': None,
+        'version': 0,
+        'rounds': build_bracket(players)
+    }
+    tournament_views[tournament_id] = build_tournament_view(tournaments[tournament_id])
+    print(f"[TOURNAMENT] {organizer} created {tournament_id} with {len(players)} players")
+
+    join_room(bracket_room(tournament_id))
+    emit('tournament_created', {'success': True, 'tournament_id': tournament_id})
+
+
+@socketio.on('start_tournament')
+@traced
+def handle_start_tournament(data):
+    tournament_id = (data.get('tournament_id') or '').upper()
+    username = data.get('username')
+    tournament = tournaments.get(tournament_id)
+
+    if tournament is None:
+        emit('tournament_started', {'success': False, 'message': 'Tournament not found'})
+        return
+    if username != tournament['organizer']:
+        emit('tournament_started', {'success': False, 'message': 'Only the organizer can start the tournament'})
+        return
+    if tournament['status'] != 'registration':
+        emit('tournament_started', {'success': False, 'message': 'Tournament already started'})
+        return
+
+    tournament['status'] = 'running'
+    update_matches(tournament_id, [])
+    print(f"[TOURNAMENT] {username} started {tournament_id}")
+    emit('tournament_started', {'success': True, 'tournament_id': tournament_id})
+
+    for match_index, match in enumerate(tournament['rounds'][0]):
+        if None in match['players']:
+            finish_match(tournament_id, 0, match_index, match['players'][0], status='bye')
+        else:
+            enqueue_match(tournament_id, 0, match_index)
+
+
+@socketio.on('join_tournament')
+@traced
+def handle_join_tournament(data):
+    tournament_id = (data.get('tournament_id') or '').upper()
+    username = data.get('username')
+
+    view = get_tournament_view(tournament_id)
+    if view is None:
+        emit('tournament_joined', {'success': False, 'message': 'Tournament not found'})
+        return
+
+    join_room(bracket_room(tournament_id))
+
+    # Registered players get their match invitations on this socket
+    if username:
+        player_sids[username] = request.sid
+        sid_to_username[request.sid] = username
+
+    # The cached view is already serialized; the page parses it itself
+    emit('tournament_joined', {'success': True, 'bracket': view}, to=request.sid)
+
+    if username:
+        deliver_pending_match(username, request.sid)
+
+
 # ---------------------
 # HELPER
 # ---------------------
@@ -0,0 +1,419 @@
+import json
+import time
+
+import pytest
+
+import server
+
+
+@pytest.fixture(autouse=True)
+def no_sleep(monkeypatch):
+    monkeypatch.setattr(server.socketio, 'sleep', lambda *args: None)
+
+
+@pytest.fixture(autouse=True)
+def stop_timers():
+    yield
+    for timers in (server.transit_timers, server.arrival_timers):
+        for timer in list(timers.values()):
+            timer.cancel()
+
+
+def client():
+    return server.socketio.test_client(server.app)
+
+
+def received(test_client, name):
+    return [r['args'][0] for r in test_client.get_received() if r['name'] == name]
+
+
+def play_until_gameplay(host, guest, spectator=None):
+    """Lobby -> choose -> redirect to game.html, the way the pages do it."""
+    lobby_a, lobby_b = client(), client()
+    lobby_a.emit('create_room', {'username': host})
+    room_code = received(lobby_a, 'room_created')[0]
+    if spectator:
+        spectator.emit('spectate_room', {'room_code': room_code})
+    lobby_b.emit('join_room_event', {'username': guest, 'room_code': room_code})
+    lobby_a.emit('start_game', {'room_code': room_code, 'username': host})
+    lobby_a.disconnect()
+    lobby_b.disconnect()
+
+    choose_a, choose_b = client(), client()
+    for choose, username, choice in [(choose_a, host, 3), (choose_b, guest, 5)]:
+        choose.emit('join_game_room', {'room_code': room_code, 'username': username})
+        choose.emit('player_ready', {'room_code': room_code, 'username': username})
+    choose_a.emit('player_chose', {'room_code': room_code, 'username': host, 'choice': 3})
+    choose_b.emit('player_chose', {'room_code': room_code, 'username': guest, 'choice': 5})
+    assert received(choose_a, 'redirect_to_gameplay')
+    return room_code, choose_a, choose_b
+
+
+def expire(timers, room_code):
+    """Run a pending timer now instead of waiting for it."""
+    timer = timers[room_code]
+    timer.cancel()
+    timer.function(*timer.args)
+
+
+def join_game_page(room_code, username):
+    game = client()
+    game.emit('join_game_room', {'room_code': room_code, 'username': username, 'last_version': -1})
+    return game, received(game, 'state_sync')[0]
+
+
+def test_choose_page_closing_before_game_page_joins_does_not_end_game():
+    room_code, choose_a, choose_b = play_until_gameplay('nav_a1', 'nav_b1')
+
+    choose_a.disconnect()
+    choose_b.disconnect()
+    _, sync = join_game_page(room_code, 'nav_a1')
+
+    assert room_code not in server.game_results
+    assert sync['snapshot']['phase'] == 'playing'
+    assert sync['snapshot']['result'] is None
+
+
+def test_choose_page_closing_after_game_page_joins_does_not_end_game():
+    room_code, choose_a, choose_b = play_until_gameplay('nav_a2', 'nav_b2')
+
+    game_a, _ = join_game_page(room_code, 'nav_a2')
+    game_b, _ = join_game_page(room_code, 'nav_b2')
+    choose_a.disconnect()
+    choose_b.disconnect()
+
+    assert room_code not in server.game_results
+    assert room_code not in server.transit_timers
+    assert not received(game_a, 'game_over')
+    assert not received(game_b, 'player_disconnected')
+
+
+def test_game_page_disconnect_ends_game():
+    room_code, choose_a, choose_b = play_until_gameplay('nav_a3', 'nav_b3')
+    game_a, _ = join_game_page(room_code, 'nav_a3')
+    game_b, _ = join_game_page(room_code, 'nav_b3')
+    choose_a.disconnect()
+    choose_b.disconnect()
+
+    game_b.disconnect()
+
+    assert server.game_results[room_code]['winner'] == 'nav_a3'
+    assert server.game_results[room_code]['reason'] == 'disconnect'
+    assert received(game_a, 'game_over')
+
+
+def test_game_ends_when_game_page_never_joins():
+    room_code, choose_a, choose_b = play_until_gameplay('nav_a4', 'nav_b4')
+    game_a, _ = join_game_page(room_code, 'nav_a4')
+    choose_a.disconnect()
+    choose_b.disconnect()
+    assert room_code not in server.game_results
+
+    # nav_b4 closed the tab during the redirect
+    expire(server.transit_timers, room_code)
+
+    assert server.game_results[room_code]['winner'] == 'nav_a4'
+    assert server.game_results[room_code]['reason'] == 'disconnect'
+    assert received(game_a, 'game_over')
+
+
+def sync_room(room_code, changes):
+    server.rooms[room_code] = ['sync_a', 'sync_b']
+    for i in range(changes):
+        server.push_state(room_code, 'turn_update', {'current_turn': 'sync_a' if i % 2 else 'sync_b'})
+    return server.state_versions[room_code]
+
+
+def test_state_sync_sends_missed_events_as_delta():
+    version = sync_room('SYNC01', 5)
+
+    sync = server.build_state_sync('SYNC01', version - 2)
+
+    assert sync['version'] == version
+    assert [e['version'] for e in sync['events']] == [version - 1, version]
+    assert 'snapshot' not in sync
+
+
+def test_state_sync_is_empty_when_up_to_date():
+    version = sync_room('SYNC02', 3)
+
+    assert server.build_state_sync('SYNC02', version) == {'version': version, 'events': []}
+
+
+@pytest.mark.parametrize('last_version', ['rolled_past', 'ahead', None, 'garbage'])
+def test_state_sync_falls_back_to_snapshot(last_version):
+    version = sync_room('SYNC03', server.STATE_LOG_SIZE + 5)
+    last_version = {'rolled_past': 2, 'ahead': version + 1}.get(last_version, last_version)
+
+    sync = server.build_state_sync('SYNC03', last_version)
+
+    assert 'events' not in sync
+    assert sync['snapshot']['version'] == version
+    assert sync['snapshot']['players'] == ['sync_a', 'sync_b']
+
+
+def test_spectator_gets_public_events_only():
+    spectator = client()
+    room_code, choose_a, choose_b = play_until_gameplay('spec_a', 'spec_b', spectator)
+    game_a, _ = join_game_page(room_code, 'spec_a')
+    game_b, _ = join_game_page(room_code, 'spec_b')
+
+    game_a.emit('chat_message', {'room_code': room_code, 'username': 'spec_a', 'message': 'Is he wearing glasses?'})
+    game_a.emit('make_guess', {'room_code': room_code, 'username': 'spec_a', 'guessed_id': 1})
+    game_b.emit('make_guess', {'room_code': room_code, 'username': 'spec_b', 'guessed_id': 3})
+
+    events = spectator.get_received()
+    names = {e['name'] for e in events}
+    assert {'spectate_result', 'phase_change', 'chat_message', 'turn_update', 'guess_result', 'game_over'} <= names
+    assert not names & {'choices_finalized', 'redirect_to_game', 'redirect_to_gameplay'}
+    for e in events:
+        payload = e['args'][0] if e['args'] else None
+        assert not (isinstance(payload, dict) and {'choice', 'choices'} & set(payload))
+    # A first game is not a rematch, the next one is
+    assert 'game_reset' not in names
+    for username in ('spec_a', 'spec_b'):
+        client().emit('player_ready', {'room_code': room_code, 'username': username})
+    assert received(spectator, 'game_reset')[0]['result'] is None
+
+
+def test_choose_phase_redirect_delay_is_not_logged_as_slow(monkeypatch):
+    monkeypatch.setattr(server.socketio, 'sleep', time.sleep)
+
+    room_code, _, _ = play_until_gameplay('trace_a', 'trace_b')
+
+    assert not [e for e in server.slow_events if e['room_code'] == room_code]
+
+
+def test_connect_and_disconnect_are_traced_once_per_call():
+    before = {name: server.handler_timings[name]['calls'] for name in ('handle_connect', 'handle_disconnect')}
+
+    client().disconnect()
+
+    for name, calls in before.items():
+        assert server.handler_timings[name]['calls'] == calls + 1
+
+
+@pytest.fixture
+def tournament_setup(monkeypatch):
+    started = []
+    monkeypatch.setattr(server, 'ensure_tournament_scheduler', lambda: None)
+    monkeypatch.setattr(server, 'start_choose_timer', started.append)
+    return started
+
+
+def drain_match_queue():
+    while server.match_queue:
+        server.spawn_tournament_match(*server.match_queue.popleft())
+
+
+def create_tournament(organizer, names):
+    organizer_page = client()
+    organizer_page.emit('create_tournament', {'username': organizer, 'players': names})
+    return organizer_page, received(organizer_page, 'tournament_created')[0]['tournament_id']
+
+
+def test_tournament_waits_for_start_and_no_shows_are_settled_by_arrival(tournament_setup):
+    names = ['idle_a', 'idle_b', 'idle_c', 'idle_d']
+    organizer, tournament_id = create_tournament('idle_org', names)
+
+    # Nothing is scheduled before the organizer starts
+    drain_match_queue()
+    assert server.tournaments[tournament_id]['status'] == 'registration'
+    assert not any(m['status'] != 'pending' for m in server.tournaments[tournament_id]['rounds'][0])
+
+    intruder = client()
+    intruder.emit('start_tournament', {'tournament_id': tournament_id, 'username': 'idle_a'})
+    assert not received(intruder, 'tournament_started')[0]['success']
+
+    # Started with no players connected: matches open and wait for them
+    organizer.emit('start_tournament', {'tournament_id': tournament_id, 'username': 'idle_org'})
+    assert received(organizer, 'tournament_started')[0]['success']
+    drain_match_queue()
+    first_round = server.tournaments[tournament_id]['rounds'][0]
+    assert [m['status'] for m in first_round] == ['playing', 'playing']
+
+    # A player who opens the bracket page late still gets their match
+    late_page = client()
+    late_page.emit('join_tournament', {'tournament_id': tournament_id, 'username': first_round[0]['players'][0]})
+    assert received(late_page, 'tournament_match')[0]['room_code'] == first_round[0]['room_code']
+
+    # Only one player of the first match turns up before the deadline
+    arrived = first_round[0]['players'][1]
+    client().emit('join_game_room', {'room_code': first_round[0]['room_code'], 'username': arrived})
+    expire(server.arrival_timers, first_round[0]['room_code'])
+
+    assert first_round[0]['status'] == 'walkover'
+    assert first_round[0]['winner'] == arrived
+    assert first_round[1]['status'] == 'playing'
+
+
+def test_tournament_match_reaches_players_still_on_game_page(tournament_setup):
+    started = tournament_setup
+    names = ['tour_a', 'tour_b', 'tour_c', 'tour_d']
+    organizer, tournament_id = create_tournament('organizer', names)
+
+    pages = {}
+    for name in names:
+        pages[name] = client()
+        pages[name].emit('join_tournament', {'tournament_id': tournament_id, 'username': name})
+    organizer.emit('start_tournament', {'tournament_id': tournament_id, 'username': 'organizer'})
+    drain_match_queue()
+
+    first_round = server.tournaments[tournament_id]['rounds'][0]
+    for match in first_round:
+        room_code = match['room_code']
+        a, b = match['players']
+        assert received(pages[a], 'tournament_match')[0]['room_code'] == room_code
+
+        # Choose phase waits for both choose pages
+        client().emit('join_game_room', {'room_code': room_code, 'username': a})
+        assert room_code not in started
+        client().emit('join_game_room', {'room_code': room_code, 'username': b})
+        assert room_code in started
+
+        # Players move on to their game pages, then b surrenders
+        pages[a] = client()
+        pages[a].emit('join_game_room', {'room_code': room_code, 'username': a, 'last_version': -1})
+        pages[a].get_received()
+        pages[a].emit('surrender', {'room_code': room_code, 'username': b})
+
+    drain_match_queue()
+    final = server.tournaments[tournament_id]['rounds'][1][0]
+    winner = final['players'][0]
+
+    # Delivered to the game page that is still open...
+    assert received(pages[winner], 'tournament_match')[0]['room_code'] == final['room_code']
+    # ...and again to whatever page the player joins next
+    result_page = client()
+    result_page.emit('join_result_room', {'room_code': first_round[0]['room_code'], 'username': winner})
+    assert received(result_page, 'tournament_match')[0]['room_code'] == final['room_code']
+    assert final['room_code'] not in started
+
+
+def test_tournament_view_is_patched_incrementally_and_cleaned_up(tournament_setup):
+    organizer, tournament_id = create_tournament('organizer', ['view_%d' % i for i in range(5)])
+    organizer.emit('start_tournament', {'tournament_id': tournament_id, 'username': 'organizer'})
+    organizer.get_received()
+    drain_match_queue()
+
+    match = server.tournaments[tournament_id]['rounds'][0][3]
+    room_code = match['room_code']
+    server.announce_game_over(room_code, {'winner': match['players'][0], 'loser': match['players'][1], 'reason': 'surrender'})
+
+    # One bracket_update per result, covering the match and the next slot
+    updates = received(organizer, 'bracket_update')
+    assert len(updates[-1]['entries']) == 2
+
+    tournament = server.tournaments[tournament_id]
+    view = json.loads(server.get_tournament_view(tournament_id))
+    assert view['rounds'] == json.loads(json.dumps(tournament['rounds']))
+    assert view['version'] == tournament['version']
+
+    server.cleanup_tournament(tournament_id)
+    assert tournament_id not in server.tournaments
+    assert tournament_id not in server.tournament_views
+    assert room_code not in server.rooms
+
+
+@pytest.fixture
+def queue_depths(monkeypatch):
+    depths = {}
+    monkeypatch.setattr(server, 'get_queue_depth', lambda sid: depths.get(sid, 0))
+    yield depths
+    server.slow_consumers.clear()
+
+
+def lobby(host, guest):
+    host_page, guest_page = client(), client()
+    host_page.emit('create_room', {'username': host})
+    room_code = received(host_page, 'room_created')[0]
+    guest_page.emit('join_room_event', {'username': guest, 'room_code': room_code})
+    host_page.get_received()
+    guest_page.get_received()
+    return room_code, host_page, guest_page
+
+
+def test_connection_is_marked_slow_at_high_watermark(queue_depths):
+    room_code, host_page, _ = lobby('slow_a1', 'slow_b1')
+    sid = server.player_sids['slow_a1']
+
+    queue_depths[sid] = server.OUTBOUND_HIGH_WATERMARK - 1
+    server.check_outbound_queues()
+    assert sid not in server.slow_consumers
+
+    queue_depths[sid] = server.OUTBOUND_HIGH_WATERMARK
+    server.check_outbound_queues()
+    assert sid in server.slow_consumers
+
+
+def test_slow_connection_skips_chat_and_coalesces_ready_count(queue_depths):
+    room_code, host_page, guest_page = lobby('slow_a2', 'slow_b2')
+    sid = server.player_sids['slow_a2']
+    queue_depths[sid] = server.OUTBOUND_HIGH_WATERMARK
+    server.check_outbound_queues()
+    dropped = server.outbound_stats['dropped_events']
+
+    guest_page.emit('chat_message', {'room_code': room_code, 'username': 'slow_b2', 'message': 'hello'})
+    for count in (1, 2):
+        server.broadcast('update_ready_count', {'ready_players': count}, room_code)
+
+    assert not received(host_page, 'chat_message')
+    assert not received(host_page, 'update_ready_count')
+    assert received(guest_page, 'chat_message')
+    assert server.outbound_stats['dropped_events'] == dropped + 1
+
+    # Caught up: latest ready count only, plus a note about the skipped chat
+    queue_depths[sid] = server.OUTBOUND_LOW_WATERMARK
+    server.check_outbound_queues()
+    assert sid not in server.slow_consumers
+    events = host_page.get_received()
+    assert [e['args'][0] for e in events if e['name'] == 'update_ready_count'] == [{'ready_players': 2}]
+    assert [e['args'][0]['username'] for e in events if e['name'] == 'chat_message'] == ['System']
+
+
+def test_slow_connection_still_gets_game_events(queue_depths):
+    room_code, host_page, _ = lobby('slow_a3', 'slow_b3')
+    sid = server.player_sids['slow_a3']
+    queue_depths[sid] = server.OUTBOUND_HIGH_WATERMARK
+    server.check_outbound_queues()
+
+    server.push_state(room_code, 'turn_update', {'current_turn': 'slow_a3'})
+    server.announce_game_over(room_code, {'winner': 'slow_a3', 'loser': 'slow_b3', 'reason': 'surrender'})
+
+    names = {e['name'] for e in host_page.get_received()}
+    assert {'turn_update', 'game_over'} <= names
+
+
+def test_stalled_connection_is_closed(queue_depths, monkeypatch):
+    closed = []
+    monkeypatch.setattr(server, 'close_connection', closed.append)
+    room_code, _, _ = lobby('slow_a4', 'slow_b4')
+    sid = server.player_sids['slow_a4']
+    queue_depths[sid] = server.OUTBOUND_HIGH_WATERMARK
+    server.check_outbound_queues()
+    stalled = server.outbound_stats['stalled_disconnects']
+
+    server.check_outbound_queues()
+    assert not closed
+
+    server.slow_consumers[sid]['since'] -= server.OUTBOUND_STALL_SECONDS + 1
+    server.check_outbound_queues()
+
+    assert closed == [sid]
+    assert sid not in server.slow_consumers
+    assert server.outbound_stats['stalled_disconnects'] == stalled + 1
+
+
+def test_close_connection_aborts_engineio_socket(monkeypatch):
+    class FakeSocket:
+        def close(self, wait=True, abort=False):
+            self.closed_with = (wait, abort)
+
+    eio_socket = FakeSocket()
+    monkeypatch.setattr(server.socketio.server.manager, 'eio_sid_from_sid', lambda sid, namespace: 'eio-1')
+    monkeypatch.setitem(server.socketio.server.eio.sockets, 'eio-1', eio_socket)
+
+    server.close_connection('sid-1')
+
+    assert eio_socket.closed_with == (False, True)
+    assert 'eio-1' not in server.socketio.server.eio.sockets